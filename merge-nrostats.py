@@ -10,23 +10,28 @@
 # will output data in the same format as the NRO stats
 #
 # This script may require you to install the following dependencies:
-# - py-radix
+# - requests
+# - pandas
+# - numpy
+# - numba
 #
 # All of these dependencies are available through 'pip'
 
-import os
-import os.path
 import sys
 import datetime
 import dateutil.parser
 import requests
-import radix
+import requests.adapters
+import pandas
+import numpy
+import numba
+import csv
 import gzip
-from io import StringIO
+import io
 import bz2
-import math
 import ipaddress
-import urllib.request
+import concurrent.futures
+import bisect
 
 ##
 # Configuration
@@ -39,7 +44,52 @@ apnic_sub	= 'apnic'
 lacnic_sub	= 'lacnic'
 ripencc_sub	= 'ripencc'
 
-tmpdir		= '/tmp'
+# Number of lines that are collected before they are written
+# to the output files
+output_batch_size	= 65536
+
+# All statistics are fetched from the same host, so we use a
+# single session with a connection pool to benefit from HTTP
+# keep-alive and avoid repeated TLS handshakes
+http_session	= requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=5, pool_maxsize=10))
+
+# Download the NRO stats at the specified URL; the body is read
+# completely, so the connection goes back to the session's pool
+# as soon as the download is done
+def download_nro_stats_url(url):
+	r = http_session.get(url)
+	r.raise_for_status()
+
+	return r
+
+# Replace the specified day by a newer date if it falls in one
+# of the sorted date ranges that are missing from the archive
+def replace_missing_day(day, missing_dateranges, rir):
+	i = bisect.bisect_right(missing_dateranges, (day, datetime.date.max)) - 1
+
+	if i >= 0 and day <= missing_dateranges[i][1]:
+		print('{} is missing for {}, replacing it by {}'.format(day, rir, missing_dateranges[i][2]))
+		day = missing_dateranges[i][2]
+
+	return day
+
+# The archive at the RIPE NCC misses AfriNIC data for certain
+# dates which we replace with newer data; the date ranges
+# must be sorted by their start date
+afrinic_missing_dateranges = (
+	(datetime.date(2011,1,1), datetime.date(2011,5,15), datetime.date(2011,5,16)),
+	(datetime.date(2014,12,31), datetime.date(2015,1,6), datetime.date(2015,1,7)),
+	(datetime.date(2015,12,31), datetime.date(2016,1,4), datetime.date(2016,1,5)),
+	(datetime.date(2016,12,31), datetime.date(2016,12,31), datetime.date(2017,1,1)),
+	(datetime.date(2017,12,31), datetime.date(2018,1,3), datetime.date(2018,1,4)),
+)
+
+# Some AfriNIC days ended up in different year directories,
+# note these exceptions
+afrinic_exception_dates = (
+	(datetime.date(2012,12,31), 2013),
+)
 
 # Retrieve NRO stats for the AfriNIC region for the
 # specified date
@@ -48,57 +98,36 @@ def fetch_afrinic_nrostats(day):
 	start_date = datetime.date(2005,3,3)
 
 	if day < start_date:
-		# Write an empty file if the day requested
-		# is not in the archives
-		tmpfile = '{}/afrinic-empty'.format(tmpdir)
-
-		fd = open(tmpfile, 'w')
-		fd.close()
-
-		return tmpfile
-
-	# The archive at the RIPE NCC misses data for 
-	# certain dates which we replace with newer
-	# data
-	missing_dateranges = []
-	missing_dateranges.append((datetime.date(2011,1,1), datetime.date(2011,5,15), datetime.date(2011,5,16)))
-	missing_dateranges.append((datetime.date(2014,12,31), datetime.date(2015,1,6), datetime.date(2015,1,7)))
-	missing_dateranges.append((datetime.date(2015,12,31), datetime.date(2016,1,4), datetime.date(2016,1,5)))
-	missing_dateranges.append((datetime.date(2016,12,31), datetime.date(2016,12,31), datetime.date(2017,1,1)))
-	missing_dateranges.append((datetime.date(2017,12,31), datetime.date(2018,1,3), datetime.date(2018,1,4)))
-
-	for daterange in missing_dateranges:
-		if day >= daterange[0] and day <= daterange[1]:
-			print('{} is missing for AfriNIC, replacing it by {}'.format(day, daterange[2]))
-			day = daterange[2]
-
-	# Some days ended up in different years, note
-	# these exceptions
-	exception_dates = []
-	exception_dates.append((datetime.date(2012,12,31), 2013))
+		# There are no statistics to fetch if the day
+		# requested is not in the archives
+		return None
+
+	day = replace_missing_day(day, afrinic_missing_dateranges, 'AfriNIC')
 
 	year = day.year
 
-	for exception in exception_dates:
+	for exception in afrinic_exception_dates:
 		if day == exception[0]:
 			print('{} is in another year directory for AfriNIC, adjusting year directory to {}'.format(day, exception[1]))
 			year = exception[1]
 
 	afrinic_url = '{}/{}/{}/delegated-afrinic-{:04d}{:02d}{:02d}'.format(ripe_base_url, afrinic_sub, year, day.year, day.month, day.day)
 
-	sys.stdout.write('Fetching AfriNIC data from {} ... '.format(afrinic_url))
-	sys.stdout.flush()
-
-	tmpfile = '{}/afrinic-{:04d}{:02d}{:02d}'.format(tmpdir, day.year, day.month, day.day)
-
 	try:
-		urllib.request.urlretrieve(afrinic_url, tmpfile)
+		r = download_nro_stats_url(afrinic_url)
 	except:
-		raise Exception('Failed to download {} to {}'.format(afrinic_url, tmpfile))
+		raise Exception('Failed to download {}'.format(afrinic_url))
 
-	print('OK ({})'.format(tmpfile))
+	print('Fetching AfriNIC data from {} ... OK'.format(afrinic_url))
 
-	return tmpfile
+	return r
+
+# The archive at the RIPE NCC misses ARIN data for certain
+# dates which we replace with newer data; the date ranges
+# must be sorted by their start date
+arin_missing_dateranges = (
+	(datetime.date(2019,8,25), datetime.date(2019,8,25), datetime.date(2019,8,26)),
+)
 
 # Retrieve NRO stats for the ARIN region for
 # the specified date
@@ -107,14 +136,9 @@ def fetch_arin_nrostats(day):
 	start_date = datetime.date(2003,11,20)
 
 	if day < start_date:
-		# Write an empty file if the day requested
-		# is not in the archives
-		tmpfile = '{}/arin-empty'.format(tmpdir)
-
-		fd = open(tmpfile, 'w')
-		fd.close()
-
-		return tmpfile
+		# There are no statistics to fetch if the day
+		# requested is not in the archives
+		return None
 
 	# The ARIN stats are a bit of a mess unfortunately
 	# so determining the right URL requires some black
@@ -140,16 +164,7 @@ def fetch_arin_nrostats(day):
 	if day.year < 2017:
 		subdir = 'archive/{}'.format(day.year)
 
-	# The archive at the RIPE NCC misses data for 
-	# certain dates which we replace with newer
-	# data
-	missing_dateranges = []
-	missing_dateranges.append((datetime.date(2019,8,25), datetime.date(2019,8,25), datetime.date(2019,8,26)))
-
-	for daterange in missing_dateranges:
-		if day >= daterange[0] and day <= daterange[1]:
-			print('{} is missing for ARIN, replacing it by {}'.format(day, daterange[2]))
-			day = daterange[2]
+	day = replace_missing_day(day, arin_missing_dateranges, 'ARIN')
 
 	if day >= datetime.date(2013,3,5):
 		filename_prefix = 'delegated-arin-extended'
@@ -169,22 +184,57 @@ def fetch_arin_nrostats(day):
 	if filename_postfix is not None:
 		arin_url += filename_postfix
 
-	sys.stdout.write('Fetching ARIN data from {} ... '.format(arin_url))
-	sys.stdout.flush()
-
-	tmpfile = '{}/arin-{:04d}{:02d}{:02d}'.format(tmpdir, day.year, day.month, day.day)
-
-	if filename_postfix is not None:
-		tmpfile += filename_postfix
-
 	try:
-		urllib.request.urlretrieve(arin_url, tmpfile)
+		r = download_nro_stats_url(arin_url)
 	except:
-		raise Exception('Failed to download {} to {}'.format(arin_url, tmpfile))
-
-	print('OK ({})'.format(tmpfile))
-
-	return tmpfile
+		raise Exception('Failed to download {}'.format(arin_url))
+
+	print('Fetching ARIN data from {} ... OK'.format(arin_url))
+
+	return r
+
+# The archive at the RIPE NCC misses APNIC data for certain
+# dates which we replace with newer data; the date ranges
+# must be sorted by their start date
+apnic_missing_dateranges = (
+	(datetime.date(2001,5,2), datetime.date(2001,5,31), datetime.date(2001,6,1)),
+	(datetime.date(2001,6,2), datetime.date(2001,8,31), datetime.date(2001,9,1)),
+	(datetime.date(2001,9,2), datetime.date(2001,9,30), datetime.date(2001,10,1)),
+	(datetime.date(2001,10,2), datetime.date(2001,10,31), datetime.date(2001,11,1)),
+	(datetime.date(2001,11,2), datetime.date(2001,11,30), datetime.date(2001,12,1)),
+	(datetime.date(2001,12,2), datetime.date(2001,12,31), datetime.date(2002,1,1)),
+	(datetime.date(2002,1,2), datetime.date(2002,1,31), datetime.date(2002,2,1)),
+	(datetime.date(2002,2,2), datetime.date(2002,2,28), datetime.date(2002,3,1)),
+	(datetime.date(2002,3,2), datetime.date(2002,3,31), datetime.date(2002,4,1)),
+	(datetime.date(2002,4,2), datetime.date(2002,4,30), datetime.date(2002,5,1)),
+	(datetime.date(2002,5,2), datetime.date(2002,5,31), datetime.date(2002,6,1)),
+	(datetime.date(2002,6,2), datetime.date(2002,6,30), datetime.date(2002,7,1)),
+	(datetime.date(2002,7,2), datetime.date(2002,7,31), datetime.date(2002,8,1)),
+	(datetime.date(2002,8,2), datetime.date(2002,8,31), datetime.date(2002,9,1)),
+	(datetime.date(2002,9,2), datetime.date(2002,9,30), datetime.date(2002,10,1)),
+	(datetime.date(2002,10,2), datetime.date(2002,10,31), datetime.date(2002,11,1)),
+	(datetime.date(2002,11,2), datetime.date(2002,11,30), datetime.date(2002,12,1)),
+	(datetime.date(2002,12,2), datetime.date(2002,12,31), datetime.date(2003,1,1)),
+	(datetime.date(2003,1,2), datetime.date(2003,1,31), datetime.date(2003,2,1)),
+	(datetime.date(2003,2,2), datetime.date(2003,2,28), datetime.date(2003,3,1)),
+	(datetime.date(2003,3,2), datetime.date(2003,3,31), datetime.date(2003,4,1)),
+	(datetime.date(2003,4,2), datetime.date(2003,4,30), datetime.date(2003,5,1)),
+	(datetime.date(2003,5,2), datetime.date(2003,5,7), datetime.date(2003,5,8)),
+)
+
+# Some APNIC days ended up in different year directories,
+# note these exceptions
+apnic_exception_dates = (
+	(datetime.date(2010,12,31), 2011),
+	(datetime.date(2011,12,31), 2012),
+	(datetime.date(2012,12,31), 2013),
+	(datetime.date(2013,12,31), 2014),
+	(datetime.date(2014,12,31), 2015),
+	(datetime.date(2015,12,31), 2016),
+	(datetime.date(2016,12,31), 2017),
+	(datetime.date(2017,12,31), 2018),
+	(datetime.date(2018,12,31), 2019),
+)
 
 # Retrieve NRO stats for the APNIC region for
 # the specified date
@@ -193,64 +243,15 @@ def fetch_apnic_nrostats(day):
 	start_date = datetime.date(2001,5,1)
 
 	if day < start_date:
-		# Write an empty file if the day requested
-		# is not in the archives
-		tmpfile = '{}/apnic-empty'.format(tmpdir)
-
-		fd = open(tmpfile, 'w')
-		fd.close()
-
-		return tmpfile
-
-	# The archive at the RIPE NCC misses data for 
-	# certain dates which we replace with newer
-	# data
-	missing_dateranges = []
-	missing_dateranges.append((datetime.date(2001,5,2), datetime.date(2001,5,31), datetime.date(2001,6,1)))
-	missing_dateranges.append((datetime.date(2001,6,2), datetime.date(2001,8,31), datetime.date(2001,9,1)))
-	missing_dateranges.append((datetime.date(2001,9,2), datetime.date(2001,9,30), datetime.date(2001,10,1)))
-	missing_dateranges.append((datetime.date(2001,10,2), datetime.date(2001,10,31), datetime.date(2001,11,1)))
-	missing_dateranges.append((datetime.date(2001,11,2), datetime.date(2001,11,30), datetime.date(2001,12,1)))
-	missing_dateranges.append((datetime.date(2001,12,2), datetime.date(2001,12,31), datetime.date(2002,1,1)))
-	missing_dateranges.append((datetime.date(2002,1,2), datetime.date(2002,1,31), datetime.date(2002,2,1)))
-	missing_dateranges.append((datetime.date(2002,2,2), datetime.date(2002,2,28), datetime.date(2002,3,1)))
-	missing_dateranges.append((datetime.date(2002,3,2), datetime.date(2002,3,31), datetime.date(2002,4,1)))
-	missing_dateranges.append((datetime.date(2002,4,2), datetime.date(2002,4,30), datetime.date(2002,5,1)))
-	missing_dateranges.append((datetime.date(2002,5,2), datetime.date(2002,5,31), datetime.date(2002,6,1)))
-	missing_dateranges.append((datetime.date(2002,6,2), datetime.date(2002,6,30), datetime.date(2002,7,1)))
-	missing_dateranges.append((datetime.date(2002,7,2), datetime.date(2002,7,31), datetime.date(2002,8,1)))
-	missing_dateranges.append((datetime.date(2002,8,2), datetime.date(2002,8,31), datetime.date(2002,9,1)))
-	missing_dateranges.append((datetime.date(2002,9,2), datetime.date(2002,9,30), datetime.date(2002,10,1)))
-	missing_dateranges.append((datetime.date(2002,10,2), datetime.date(2002,10,31), datetime.date(2002,11,1)))
-	missing_dateranges.append((datetime.date(2002,11,2), datetime.date(2002,11,30), datetime.date(2002,12,1)))
-	missing_dateranges.append((datetime.date(2002,12,2), datetime.date(2002,12,31), datetime.date(2003,1,1)))
-	missing_dateranges.append((datetime.date(2003,1,2), datetime.date(2003,1,31), datetime.date(2003,2,1)))
-	missing_dateranges.append((datetime.date(2003,2,2), datetime.date(2003,2,28), datetime.date(2003,3,1)))
-	missing_dateranges.append((datetime.date(2003,3,2), datetime.date(2003,3,31), datetime.date(2003,4,1)))
-	missing_dateranges.append((datetime.date(2003,4,2), datetime.date(2003,4,30), datetime.date(2003,5,1)))
-	missing_dateranges.append((datetime.date(2003,5,2), datetime.date(2003,5,7), datetime.date(2003,5,8)))
-
-	for daterange in missing_dateranges:
-		if day >= daterange[0] and day <= daterange[1]:
-			print('{} is missing for APNIC, replacing it by {}'.format(day, daterange[2]))
-			day = daterange[2]
-
-	# Some days ended up in different years, note
-	# these exceptions
-	exception_dates = []
-	exception_dates.append((datetime.date(2010,12,31), 2011))
-	exception_dates.append((datetime.date(2011,12,31), 2012))
-	exception_dates.append((datetime.date(2012,12,31), 2013))
-	exception_dates.append((datetime.date(2013,12,31), 2014))
-	exception_dates.append((datetime.date(2014,12,31), 2015))
-	exception_dates.append((datetime.date(2015,12,31), 2016))
-	exception_dates.append((datetime.date(2016,12,31), 2017))
-	exception_dates.append((datetime.date(2017,12,31), 2018))
-	exception_dates.append((datetime.date(2018,12,31), 2019))
+		# There are no statistics to fetch if the day
+		# requested is not in the archives
+		return None
+
+	day = replace_missing_day(day, apnic_missing_dateranges, 'APNIC')
 
 	year = day.year
 
-	for exception in exception_dates:
+	for exception in apnic_exception_dates:
 		if day == exception[0]:
 			print('{} is in another year directory for APNIC, adjusting year directory to {}'.format(day, exception[1]))
 			year = exception[1]
@@ -266,19 +267,24 @@ def fetch_apnic_nrostats(day):
 
 	apnic_url = '{}/{}/{}/{}'.format(ripe_base_url, apnic_sub, year, filename)
 
-	sys.stdout.write('Fetching APNIC data from {} ... '.format(apnic_url))
-	sys.stdout.flush()
-
-	tmpfile = '{}/apnic-{:04d}{:02d}{:02d}.gz'.format(tmpdir, day.year, day.month, day.day)
-
 	try:
-		urllib.request.urlretrieve(apnic_url, tmpfile)
+		r = download_nro_stats_url(apnic_url)
 	except:
-		raise Exception('Failed to download {} to {}'.format(apnic_url, tmpfile))
+		raise Exception('Failed to download {}'.format(apnic_url))
 
-	print('OK ({})'.format(tmpfile))
+	print('Fetching APNIC data from {} ... OK'.format(apnic_url))
 
-	return tmpfile
+	return r
+
+# The archive at the RIPE NCC misses LACNIC data for certain
+# dates which we replace with newer data; the date ranges
+# must be sorted by their start date
+lacnic_missing_dateranges = (
+	(datetime.date(2018,9,26), datetime.date(2018,9,26), datetime.date(2018,9,27)),
+	(datetime.date(2018,11,10), datetime.date(2018,11,10), datetime.date(2018,11,11)),
+	(datetime.date(2019,12,21), datetime.date(2019,12,21), datetime.date(2019,12,22)),
+	(datetime.date(2020,4,22), datetime.date(2020,4,22), datetime.date(2020,4,23)),
+)
 
 # Retrieve NRO stats for the LACNIC region for
 # the specified date
@@ -287,46 +293,24 @@ def fetch_lacnic_nrostats(day):
 	start_date = datetime.date(2004,1,1)
 
 	if day < start_date:
-		# Write an empty file if the day requested
-		# is not in the archives
-		tmpfile = '{}/lacnic-empty'.format(tmpdir)
-
-		fd = open(tmpfile, 'w')
-		fd.close()
+		# There are no statistics to fetch if the day
+		# requested is not in the archives
+		return None
 
-		return tmpfile
-
-	# The archive at the RIPE NCC misses data for 
-	# certain dates which we replace with newer
-	# data
-	missing_dateranges = []
-	missing_dateranges.append((datetime.date(2018,9,26), datetime.date(2018,9,26), datetime.date(2018,9,27)))
-	missing_dateranges.append((datetime.date(2018,11,10), datetime.date(2018,11,10), datetime.date(2018,11,11)))
-	missing_dateranges.append((datetime.date(2019,12,21), datetime.date(2019,12,21), datetime.date(2019,12,22)))
-	missing_dateranges.append((datetime.date(2020,4,22), datetime.date(2020,4,22), datetime.date(2020,4,23)))
-
-	for daterange in missing_dateranges:
-		if day >= daterange[0] and day <= daterange[1]:
-			print('{} is missing for LACNIC, replacing it by {}'.format(day, daterange[2]))
-			day = daterange[2]
+	day = replace_missing_day(day, lacnic_missing_dateranges, 'LACNIC')
 
 	# The LACNIC data should all be in a single
 	# directory, without any exceptions
 	lacnic_url = '{}/{}/delegated-lacnic-{:04d}{:02d}{:02d}'.format(ripe_base_url, lacnic_sub, day.year, day.month, day.day)
 
-	sys.stdout.write('Fetching LACNIC data from {} ... '.format(lacnic_url))
-	sys.stdout.flush()
-
-	tmpfile = '{}/lacnic-{:04d}{:02d}{:02d}'.format(tmpdir, day.year, day.month, day.day)
-
 	try:
-		urllib.request.urlretrieve(lacnic_url, tmpfile)
+		r = download_nro_stats_url(lacnic_url)
 	except:
-		raise Exception('Failed to download {} to {}'.format(lacnic_url, tmpfile))
+		raise Exception('Failed to download {}'.format(lacnic_url))
 
-	print('OK ({})'.format(tmpfile))
+	print('Fetching LACNIC data from {} ... OK'.format(lacnic_url))
 
-	return tmpfile
+	return r
 
 # Retrieve NRO stats for the RIPE region for
 # the specified date
@@ -335,14 +319,9 @@ def fetch_ripencc_nrostats(day):
 	start_date = datetime.date(2003,11,26)
 
 	if day < start_date:
-		# Write an empty file if the day requested
-		# is not in the archives
-		tmpfile = '{}/ripencc-empty'.format(tmpdir)
-
-		fd = open(tmpfile, 'w')
-		fd.close()
-
-		return tmpfile
+		# There are no statistics to fetch if the day
+		# requested is not in the archives
+		return None
 
 	# The RIPE NCC's archives are split up
 	# by year with, annoyingly, a single
@@ -355,201 +334,264 @@ def fetch_ripencc_nrostats(day):
 
 	ripencc_url = '{}/{}/{}/delegated-ripencc-{:04d}{:02d}{:02d}.bz2'.format(ripe_base_url, ripencc_sub, year, day.year, day.month, day.day)
 
-	sys.stdout.write('Fetching RIPE data from {} ... '.format(ripencc_url))
-	sys.stdout.flush()
-
-	tmpfile = '{}/ripencc-{:04d}{:02d}{:02d}.bz2'.format(tmpdir, day.year, day.month, day.day)
-
 	try:
-		urllib.request.urlretrieve(ripencc_url, tmpfile)
+		r = download_nro_stats_url(ripencc_url)
 	except:
-		raise Exception('Failed to download {} to {}'.format(ripencc_url, tmpfile))
+		raise Exception('Failed to download {}'.format(ripencc_url))
 
-	print('OK ({})'.format(tmpfile))
+	print('Fetching RIPE data from {} ... OK'.format(ripencc_url))
 
-	return tmpfile
+	return r
 
-# Added the specified prefix to the radix tree and check if
-# it might already be present
-def add_prefix_to_radix(radix, prefix, prefix_info):
-	# Find out if the prefix is already there
-	rnode = radix.search_exact(prefix)
+# Determine the size of the largest IPv4 subprefix that starts at
+# the specified address and covers no more than the specified
+# number of addresses. The size is limited both by the number of
+# addresses left and by the alignment of the starting address,
+# which is given by the number of trailing zero bits
+@numba.njit(cache=True)
+def v4_subprefix_size(prefix_addr, addrcount):
+	count_bits = 0
 
-	if rnode is None:
-		rnode = radix.add(prefix)
-	else:
-		print('Warning: {} already in radix tree'.format(prefix))
+	while (addrcount >> (count_bits + 1)) > 0:
+		count_bits += 1
 
-	info_arr = rnode.data.get('info', [])
-	info_arr.append(prefix_info)
-	rnode.data['info'] = info_arr
+	addr_align = 0
 
-# Adding an IPv4 address to the radix tree is tricky, since the
-# number of IP addresses in the block in the NRO stats is not
-# necessarily a power of two. We first test if it is a power of
-# 2, and if it is not, we need to factorize it to get the
-# subprefixes
-def add_v4_block_to_radix(v4radix, prefix_addr, addrcount, prefix_info):
-	prefix_addr = ipaddress.ip_address(prefix_addr)
+	while addr_align < 32 and ((prefix_addr >> addr_align) & 1) == 0:
+		addr_align += 1
 
-	while addrcount > 0:
-		prefix_size = 32 - int(math.log(addrcount, 2))
+	return 32 - min(count_bits, addr_align)
 
-		prefix_found = False
+# Adding an IPv4 address block is tricky, since the number of IP
+# addresses in the block in the NRO stats is not necessarily a
+# power of two. We first test if it is a power of 2, and if it is
+# not, we need to factorize it to get the subprefixes. This is a
+# numeric loop over all blocks in a file, so it is compiled with
+# numba; it returns the address and size of every subprefix along
+# with the index of the block it belongs to
+@numba.njit(cache=True)
+def decompose_v4_blocks(addrs, counts):
+	# Count the subprefixes first, so the output arrays
+	# can be allocated at once
+	subprefix_count = 0
 
-		while not prefix_found:
-			try:
-				test_nw = ipaddress.IPv4Network('{}/{}'.format(prefix_addr, prefix_size))
-				prefix_found = True
-			except ValueError as v:
-				prefix_size += 1
+	for i in range(addrs.shape[0]):
+		prefix_addr = addrs[i]
+		addrcount = counts[i]
 
-		prefix = '{}/{}'.format(prefix_addr, prefix_size)
+		while addrcount > 0:
+			used_addrcount = 1 << (32 - v4_subprefix_size(prefix_addr, addrcount))
+			addrcount -= used_addrcount
+			prefix_addr += used_addrcount
+			subprefix_count += 1
 
-		used_addrcount = int(math.pow(2, 32 - prefix_size))
-		add_prefix_to_radix(v4radix, prefix, prefix_info + (used_addrcount,))
+	out_addrs = numpy.empty(subprefix_count, numpy.int64)
+	out_sizes = numpy.empty(subprefix_count, numpy.int64)
+	out_blocks = numpy.empty(subprefix_count, numpy.int64)
 
-		addrcount -= used_addrcount
-		prefix_addr += used_addrcount
+	j = 0
 
-# This is a very crude parser that will only process NRO stat lines
-# that are for IPv4 or IPv6 prefixes and the contain exactly 7 fields
-# separated by a '|' sign.
-def parse_nro_stats(fd, v4radix, v6radix):
-	for line in fd:
-		if type(line) is bytes:
-			line = line.decode('utf8')
-		line = line.strip('\r').strip('\n')
-		fields = line.split('|')
-
-		if len(fields) < 7 or (fields[2] != 'ipv4' and fields[2] != 'ipv6'):
-			continue
-
-		# We put the following information about the
-		# prefix in the tuple:
-		#  - RIR name
-		#  - country
-		#  - date of modification/assignment
-		#  - prefix status
-		#  - original starting block
-		#  - original block IP count
-		prefix_info = (fields[0], fields[1], fields[5], fields[6], fields[3], int(fields[4]))
-
-		prefix_size = 0
-		prefix_addr = fields[3]
-
-		if fields[2] == 'ipv4':
-			addrcount = int(fields[4])
-			add_v4_block_to_radix(v4radix, prefix_addr, addrcount, prefix_info)
-		elif fields[2] == 'ipv6':
-			# IPv6 entries just specify the prefix
-			# size
-			prefix_size = int(fields[4])
-			prefix = '{}/{}'.format(prefix_addr, prefix_size)
-			add_prefix_to_radix(v6radix, prefix, prefix_info)
-
-def open_nro_stats_file(filename):
-	if filename.endswith('.gz'):
-		return gzip.open(filename, 'r')
-	elif filename.endswith('.bz2'):
-		return bz2.BZ2File(filename, 'r')
-	else:
-		return open(filename, 'r')
+	for i in range(addrs.shape[0]):
+		prefix_addr = addrs[i]
+		addrcount = counts[i]
 
-##
-# Main entry point
-##
+		while addrcount > 0:
+			prefix_size = v4_subprefix_size(prefix_addr, addrcount)
+			used_addrcount = 1 << (32 - prefix_size)
 
-def main():
-	if len(sys.argv) != 3:
-		print('Usage: merge-nrostats.py <date> <output directory>')
-		return
+			out_addrs[j] = prefix_addr
+			out_sizes[j] = prefix_size
+			out_blocks[j] = i
+			j += 1
 
-	day = dateutil.parser.parse(sys.argv[1]).date()
-	outdir = sys.argv[2]
+			addrcount -= used_addrcount
+			prefix_addr += used_addrcount
 
-	v4radix = radix.Radix()
-	v6radix = radix.Radix()
+	return out_addrs, out_sizes, out_blocks
 
-	afrinic_file	= None
-	arin_file	= None
-	apnic_file	= None
-	lacnic_file	= None
-	ripencc_file	= None
-
-	try:
-		afrinic_file	= fetch_afrinic_nrostats(day)
-		arin_file	= fetch_arin_nrostats(day)
-		apnic_file	= fetch_apnic_nrostats(day)
-		lacnic_file	= fetch_lacnic_nrostats(day)
-		ripencc_file	= fetch_ripencc_nrostats(day)
-
-		# AfriNIC
-		sys.stdout.write('Parsing AfriNIC NRO statistics for {} ... '.format(day))
-		sys.stdout.flush()
+# This is a very crude parser that will only process NRO stat lines
+# that are for IPv4 or IPv6 prefixes and the contain at least 7 fields
+# separated by a '|' sign. Lines that are not for IPv4 or IPv6, or
+# that have too few fields, are dropped on the raw bytes before
+# anything is decoded. The remaining lines are split into fields by
+# pandas, which does this in C. IPv4 blocks are converted to arrays
+# and decomposed into subprefixes in one go, the resulting prefixes
+# are then stored one by one.
+#
+# As we never look up prefixes, but only store them to output them
+# in order later, the prefixes are kept in dicts rather than trees:
+# IPv4 prefixes are keyed by their integer address and prefix size,
+# IPv6 prefixes by the canonical form of the prefix. A single lookup
+# per prefix both finds duplicates and gets the list to add the
+# information to.
+def parse_nro_stats(fd, v4prefixes, v6prefixes):
+	# Read the whole file and split it into lines in one go,
+	# rather than reading it line by line; this also drops lines
+	# with fewer than 7 fields, such as the summary lines
+	records = [line for line in fd.read().splitlines() if (b'|ipv4|' in line or b'|ipv6|' in line) and line.count(b'|') >= 6]
+
+	if len(records) == 0:
+		return
 
-		afrinic_fd = open_nro_stats_file(afrinic_file)
+	stats = pandas.read_csv(io.BytesIO(b'\n'.join(records)), sep='|', header=None, names=range(7), usecols=range(7), dtype=str, keep_default_na=False, quoting=csv.QUOTE_NONE, encoding='utf-8')
+
+	v4_stats = stats[stats[2] == 'ipv4']
+	v6_stats = stats[stats[2] == 'ipv6']
+
+	# We put the following information about each
+	# prefix in a list:
+	#  - RIR name
+	#  - country
+	#  - date of modification/assignment
+	#  - prefix status
+	#  - original starting block
+	#  - original block IP count
+	#  - IP count of the prefix (IPv4 only)
+	if len(v4_stats) > 0:
+		octets = v4_stats[3].str.split('.', expand=True).astype(numpy.int64).to_numpy()
+		addrs = (octets[:, 0] << 24) | (octets[:, 1] << 16) | (octets[:, 2] << 8) | octets[:, 3]
+		counts = v4_stats[4].astype(numpy.int64).to_numpy()
+
+		v4_info = [[fields[0], fields[1], fields[5], fields[6], fields[3], int(fields[4])] for fields in v4_stats.itertuples(index=False, name=None)]
+
+		out_addrs, out_sizes, out_blocks = decompose_v4_blocks(addrs, counts)
+
+		for prefix_addr, prefix_size, block in zip(out_addrs.tolist(), out_sizes.tolist(), out_blocks.tolist()):
+			prefix_info = [*v4_info[block], 1 << (32 - prefix_size)]
+			info_arr = v4prefixes.get((prefix_addr, prefix_size))
+
+			if info_arr is None:
+				v4prefixes[(prefix_addr, prefix_size)] = [prefix_info]
+			else:
+				print('Warning: {}/{} already in prefix table'.format(ipaddress.IPv4Address(prefix_addr), prefix_size))
+				info_arr.append(prefix_info)
+
+	for fields in v6_stats.itertuples(index=False, name=None):
+		prefix_info = [fields[0], fields[1], fields[5], fields[6], fields[3], int(fields[4])]
+
+		# IPv6 entries just specify the prefix
+		# size; different spellings of the same
+		# prefix must end up under the same key
+		prefix = str(ipaddress.IPv6Network(f'{fields[3]}/{int(fields[4])}', strict=False))
+		info_arr = v6prefixes.get(prefix)
+
+		if info_arr is None:
+			v6prefixes[prefix] = [prefix_info]
+		else:
+			print('Warning: {} already in prefix table'.format(prefix))
+			info_arr.append(prefix_info)
+
+# Open the downloaded NRO stats for parsing, decompressing them
+# on the fly if needed
+def open_nro_stats_file(url, body):
+	if url.endswith('.gz'):
+		return gzip.GzipFile(fileobj=io.BytesIO(body), mode='rb')
+	elif url.endswith('.bz2'):
+		return bz2.BZ2File(io.BytesIO(body), 'rb')
+	else:
+		return io.BytesIO(body)
 
-		parse_nro_stats(afrinic_fd, v4radix, v6radix)
+# Parse the downloaded NRO stats of a single RIR. This runs in a
+# worker process, so the parsed prefixes are returned as lists of
+# prefixes and their information, which can be pickled, rather
+# than as the tables themselves
+def parse_nro_stats_body(url, body):
+	v4prefixes = {}
+	v6prefixes = {}
 
-		afrinic_fd.close()
+	stats_fd = open_nro_stats_file(url, body)
 
-		print('OK')
+	parse_nro_stats(stats_fd, v4prefixes, v6prefixes)
 
-		# ARIN
-		sys.stdout.write('Parsing ARIN NRO statistics for {} ... '.format(day))
-		sys.stdout.flush()
+	stats_fd.close()
 
-		arin_fd = open_nro_stats_file(arin_file)
+	return list(v4prefixes.items()), list(v6prefixes.items())
 
-		parse_nro_stats(arin_fd, v4radix, v6radix)
+# Merge the prefixes parsed from the NRO stats of a single RIR
+# into the combined tables
+def merge_nro_stats(v4prefixes, v6prefixes, v4_list, v6_list):
+	for v4_key, info_arr in v4_list:
+		merged_arr = v4prefixes.get(v4_key)
 
-		arin_fd.close()
+		if merged_arr is None:
+			v4prefixes[v4_key] = info_arr
+		else:
+			print('Warning: {}/{} already in prefix table'.format(ipaddress.IPv4Address(v4_key[0]), v4_key[1]))
+			merged_arr.extend(info_arr)
 
-		print('OK')
+	for prefix, info_arr in v6_list:
+		merged_arr = v6prefixes.get(prefix)
 
-		# APNIC
-		sys.stdout.write('Parsing APNIC NRO statistics for {} ... '.format(day))
-		sys.stdout.flush()
+		if merged_arr is None:
+			v6prefixes[prefix] = info_arr
+		else:
+			print('Warning: {} already in prefix table'.format(prefix))
+			merged_arr.extend(info_arr)
 
-		apnic_fd = open_nro_stats_file(apnic_file)
+##
+# Main entry point
+##
 
-		parse_nro_stats(apnic_fd, v4radix, v6radix)
+def main():
+	if len(sys.argv) != 3:
+		print('Usage: merge-nrostats.py <date> <output directory>')
+		return
 
-		apnic_fd.close()
+	day = dateutil.parser.parse(sys.argv[1]).date()
+	outdir = sys.argv[2]
 
-		print('OK')
+	v4prefixes = {}
+	v6prefixes = {}
 
-		# LACNIC
-		sys.stdout.write('Parsing LACNIC NRO statistics for {} ... '.format(day))
-		sys.stdout.flush()
+	try:
+		# Fetching the statistics is bound by network latency
+		# rather than CPU, so we download the files for all
+		# RIRs in parallel using a pool of threads that share
+		# the HTTP session
+		with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+			afrinic_future	= executor.submit(fetch_afrinic_nrostats, day)
+			arin_future	= executor.submit(fetch_arin_nrostats, day)
+			apnic_future	= executor.submit(fetch_apnic_nrostats, day)
+			lacnic_future	= executor.submit(fetch_lacnic_nrostats, day)
+			ripencc_future	= executor.submit(fetch_ripencc_nrostats, day)
 
-		lacnic_fd = open_nro_stats_file(lacnic_file)
+		# Parsing the statistics is CPU bound, so each RIR is
+		# parsed in a worker process of its own; the results
+		# are merged in a fixed RIR order so the output does
+		# not depend on which worker finishes first
+		with concurrent.futures.ProcessPoolExecutor(max_workers=5) as executor:
+			parse_futures = []
 
-		parse_nro_stats(lacnic_fd, v4radix, v6radix)
+			for rir, future in [('AfriNIC', afrinic_future), ('ARIN', arin_future), ('APNIC', apnic_future), ('LACNIC', lacnic_future), ('RIPE NCC', ripencc_future)]:
+				r = future.result()
 
-		lacnic_fd.close()
+				# Skip RIRs for which the day requested is
+				# not in the archives
+				if r is None:
+					print('No {} NRO statistics archived for {}'.format(rir, day))
+					continue
 
-		print('OK')
+				parse_futures.append((rir, executor.submit(parse_nro_stats_body, r.url, r.content)))
 
-		# RIPE NCC
-		sys.stdout.write('Parsing RIPE NCC NRO statistics for {} ... '.format(day))
-		sys.stdout.flush()
-		
-		ripencc_fd = open_nro_stats_file(ripencc_file)
+			for rir, future in parse_futures:
+				parsed_stats = future.result()
 
-		parse_nro_stats(ripencc_fd, v4radix, v6radix)
+				sys.stdout.write('Merging {} NRO statistics for {} ... '.format(rir, day))
+				sys.stdout.flush()
 
-		ripencc_fd.close()
+				merge_nro_stats(v4prefixes, v6prefixes, *parsed_stats)
 
-		print('OK')
+				print('OK')
 
 		# Write the consolidated NRO statistics to file
 		v4_file = '{}/nrostats-{:04d}{:02d}{:02d}-v4.csv'.format(outdir, day.year, day.month, day.day)
 		v6_file = '{}/nrostats-{:04d}{:02d}{:02d}-v6.csv'.format(outdir, day.year, day.month, day.day)
 
-		v4_fd = open(v4_file, 'w')
-		v6_fd = open(v6_file, 'w')
+		# Lines are collected in batches that are joined and
+		# written at once through a large buffer, to keep the
+		# number of write calls down
+		v4_fd = open(v4_file, 'w', buffering=1<<20)
+		v6_fd = open(v6_file, 'w', buffering=1<<20)
 
 		v4_fd.write('prefix,rir,date,country_code,status,block_start,block_ip_count\n')
 		v6_fd.write('prefix,rir,date,country_code,status\n')
@@ -557,10 +599,14 @@ def main():
 		sys.stdout.write('Writing IPv4 NRO statistics to {} ... '.format(v4_file))
 		sys.stdout.flush()
 
-		for rnode in v4radix:
-			prefix = rnode.prefix
+		lines = []
+
+		# Sorting on integer address and prefix size yields the
+		# same order as a tree walk
+		for (prefix_addr, prefix_size), info_arr in sorted(v4prefixes.items()):
+			prefix = str(ipaddress.IPv4Network((prefix_addr, prefix_size)))
 
-			for info in rnode.data['info']:
+			for info in info_arr:
 				rir 		= info[0]
 				date 		= info[1]
 				country 	= info[2]
@@ -568,23 +614,37 @@ def main():
 				block_start	= info[4]
 				block_ip_count	= info[5]
 
-				v4_fd.write('{},{},{},{},{},{},{}\n'.format(prefix, rir, country, date, prefix_status, block_start, block_ip_count))
+				lines.append(f'{prefix},{rir},{country},{date},{prefix_status},{block_start},{block_ip_count}\n')
+
+				if len(lines) >= output_batch_size:
+					v4_fd.write(''.join(lines))
+					lines = []
+
+		v4_fd.write(''.join(lines))
 
 		print('OK')
 
 		sys.stdout.write('Writing IPv6 NRO statistics to {} ... '.format(v6_file))
 		sys.stdout.flush()
 
-		for rnode in v6radix:
-			prefix = rnode.prefix
+		lines = []
 
-			for info in rnode.data['info']:
+		# Sorting on the network objects orders the prefixes by
+		# address and prefix size, the same order as a tree walk
+		for prefix, info_arr in sorted(v6prefixes.items(), key=lambda item: ipaddress.IPv6Network(item[0])):
+			for info in info_arr:
 				rir 		= info[0]
 				date 		= info[1]
 				country 	= info[2]
 				prefix_status	= info[3]
 
-				v6_fd.write('{},{},{},{},{}\n'.format(prefix, rir, country, date, prefix_status))
+				lines.append(f'{prefix},{rir},{country},{date},{prefix_status}\n')
+
+				if len(lines) >= output_batch_size:
+					v6_fd.write(''.join(lines))
+					lines = []
+
+		v6_fd.write(''.join(lines))
 
 		print('OK')
 
@@ -592,17 +652,6 @@ def main():
 		v6_fd.close()
 	except Exception as e:
 		print('Failed to retrieve and merge NRO statistics ({})'.format(e))
-	finally:
-		if afrinic_file is not None:
-			os.unlink(afrinic_file)
-		if arin_file is not None:
-			os.unlink(arin_file)
-		if apnic_file is not None:
-			os.unlink(apnic_file)
-		if lacnic_file is not None:
-			os.unlink(lacnic_file)
-		if ripencc_file is not None:
-			os.unlink(ripencc_file)
 
 	return
 